@@ -28,18 +28,43 @@ Notes:
   (which is used to speak to the router).
   Support for the latter could/should be added
   in the future.
+- if numba is installed, incoming frames are
+  parsed and LEDs are drawn by JIT-compiled code.
 """
 
 import argparse
-import copy
+import array
+import os
 import signal
 import socket
+import struct
 import sys
-import threading
 import traceback
 
 import cairo
-from gi.repository import Gtk, GObject
+from gi.repository import Gtk, GLib
+
+try:
+    import numba
+    import numpy
+except ImportError: # optional, only makes frame parsing and drawing faster
+    numba = None
+
+
+ESCAPE_MARK = 0x54
+START_MARK = 0x55
+ESCAPE_ESCAPED = 0x00
+START_ESCAPED = 0x01
+
+_UNESCAPE = {ESCAPE_ESCAPED: ESCAPE_MARK, START_ESCAPED: START_MARK}
+
+# cairo.FORMAT_ARGB32 pixels are native endian 32 bit integers
+_pack_argb32 = struct.Struct("=I").pack
+
+STATE_VIOLATION = -1
+STATE_IGNORE = 0
+STATE_NORMAL = 1
+STATE_ESCAPE = 2
 
 
 class Model(object):
@@ -48,27 +73,39 @@ class Model(object):
         self.observers = []
         self.modules = modules
         self.leds_per_module = leds_per_module
-        self.back_buffer = [[[0, 0, 0] # [r, g, b]
+        self._stride = self.leds_per_module * 3
+        # flat [r, g, b, r, g, b, ...], one module after the other
+        self.back_buffer = array.array('B', bytes(self.modules * self._stride))
+        self.front_buffer = array.array('B', self.back_buffer)
+        self.dirty = [(y, x) # (module, led) cells changed by the last strobe
+            for y in range(self.modules)
             for x in range(self.leds_per_module)]
-            for y in range(self.modules)]
-        self.front_buffer = copy.deepcopy(self.back_buffer)
 
     def set_value(self, module, channel, value):
         """set a channel brightness; takes effect when `strobe()` is called"""
-        try:
-            self.back_buffer[module][channel // 3][channel % 3] = value
-        except IndexError as e:
-            pass
+        if module < self.modules and channel < self._stride:
+            self.back_buffer[module * self._stride + channel] = value
 
     def add_observer(self, func):
-        """add a function thats called once per strobe command"""
+        """add a function thats called once per strobe command,
+        with the list of (module, led) cells that changed"""
         self.observers.append(func)
 
     def strobe(self):
         """apply led state changes"""
-        self.front_buffer = copy.deepcopy(self.back_buffer)
+        front, back = self.front_buffer, self.back_buffer
+        if front == back:
+            self.dirty = []
+        else:
+            leds = self.leds_per_module
+            self.dirty = [divmod(cell, leds)
+                for cell in range(self.modules * leds)
+                if front[3 * cell] != back[3 * cell]
+                or front[3 * cell + 1] != back[3 * cell + 1]
+                or front[3 * cell + 2] != back[3 * cell + 2]]
+            front[:] = back
         for observer in self.observers:
-            observer()
+            observer(self.dirty)
 
 
 class GtkView(object):
@@ -80,7 +117,6 @@ class GtkView(object):
 
     def run(self):
         signal.signal(signal.SIGINT, signal.SIG_DFL) # fix ctrl-c
-        GObject.threads_init()
         Gtk.main() # blocks until window is closed
 
     def init(self):
@@ -100,36 +136,79 @@ class GtkView(object):
         self.double_buffer = None
         self.window.show()
 
-    def please_redraw(self):
-        def idle_func():
-            self.redraw()
-            self.drawing.queue_draw()
-            return False # don't reschedule automatically
-        GObject.idle_add(idle_func)
-
-    def redraw(self):
-        db = self.double_buffer
-        cc = cairo.Context(db)
-        cc.scale(db.get_width(), db.get_height())
-        cc.set_source_rgb(1, 1, 1)
+    def please_redraw(self, dirty):
+        if not dirty or self.double_buffer is None:
+            return # nothing changed, or nothing to draw on yet
+        self.redraw(dirty)
+        self.drawing.queue_draw_area(*self._bounding_box(dirty))
 
+    def _bounding_box(self, cells):
+        """device space (x, y, w, h) covering all given cells"""
+        cols = self.model.leds_per_module
+        rects = [self._cell_rects[y * cols + x] for y, x in cells]
+        x0 = min(rect[0] for rect in rects)
+        y0 = min(rect[1] for rect in rects)
+        x1 = max(rect[2] for rect in rects)
+        y1 = max(rect[3] for rect in rects)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def _update_cell_rects(self):
+        """pixel (x0, y0, x1, y1) of each cell, in front buffer order"""
+        width = self.double_buffer.get_width()
+        height = self.double_buffer.get_height()
+        rows = self.model.modules
+        cols = self.model.leds_per_module
+        self._cell_rects = [(
+                x * width // cols, y * height // rows,
+                (x + 1) * width // cols, (y + 1) * height // rows)
+            for y in range(rows)
+            for x in range(cols)]
+        if numba is not None:
+            self._cell_rects_array = numpy.array(
+                self._cell_rects, dtype=numpy.intp)
+
+    def redraw(self, cells=None):
+        """repaint the given (module, led) cells; all cells by default"""
         rows = self.model.modules
         cols = self.model.leds_per_module
-        cell_size_w = 1.0 / cols
-        cell_size_h = 1.0 / rows
-        line_width = 1.0
-        line_width, _ = cc.device_to_user(line_width, 0.0)
-
-        for y in range(self.model.modules):
-            for x in range(self.model.leds_per_module):
-                cc.rectangle(
-                    x * cell_size_w, y * cell_size_h,
-                    cell_size_w, cell_size_h)
-                cc.set_line_width(line_width)
-                cc.set_source_rgb(*self.model.front_buffer[y][x])
-                cc.fill()
+        if cells is None:
+            cells = [(y, x) for y in range(rows) for x in range(cols)]
 
+        # every cell is a solid, pixel-aligned rectangle, so write
+        # the pixels directly instead of having cairo fill paths
+        db = self.double_buffer
         db.flush()
+        if numba is not None:
+            self._redraw_jit(db, cells)
+        else:
+            self._redraw_py(db, cells)
+        db.mark_dirty()
+
+    def _redraw_jit(self, db, cells):
+        cols = self.model.leds_per_module
+        pixels = numpy.frombuffer(db.get_data(), dtype=numpy.uint32)
+        pixels = pixels.reshape(db.get_height(), db.get_stride() // 4)
+        front_buffer = numpy.frombuffer(self.model.front_buffer, dtype=numpy.uint8)
+        cells = numpy.array([y * cols + x for y, x in cells], dtype=numpy.intp)
+        _render_cells(pixels, front_buffer, self._cell_rects_array, cells)
+
+    def _redraw_py(self, db, cells):
+        cols = self.model.leds_per_module
+        pixels = db.get_data()
+        stride = db.get_stride()
+        front_buffer = self.model.front_buffer
+        cell_rects = self._cell_rects
+        for y, x in cells:
+            cell = y * cols + x
+            i = cell * 3
+            x0, y0, x1, y1 = cell_rects[cell]
+            line = _pack_argb32(0xff000000
+                | front_buffer[i] << 16
+                | front_buffer[i + 1] << 8
+                | front_buffer[i + 2]) * (x1 - x0)
+            start = y0 * stride + x0 * 4
+            for offset in range(start, start + (y1 - y0) * stride, stride):
+                pixels[offset:offset + len(line)] = line
 
     def on_destroy(self, widget):
         Gtk.main_quit()
@@ -147,6 +226,7 @@ class GtkView(object):
             cairo.FORMAT_ARGB32,
             widget.get_allocated_width(),
             widget.get_allocated_height())
+        self._update_cell_rects()
         self.redraw()
         return False
 
@@ -156,76 +236,207 @@ class NetworkByteSource(object):
     def __init__(self, addr):
         self.addr = addr
 
-    def get_bytes(self):
-        server_sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_sck.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_sck.bind(self.addr)
-        server_sck.listen(5)
-        while True:
+    def start(self, on_bytes):
+        """call `on_bytes(chunk)` from the main loop when data arrives"""
+        self.on_bytes = on_bytes
+        self.server_sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sck.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_sck.bind(self.addr)
+        self.server_sck.listen(5)
+        self.server_sck.setblocking(False)
+        self._watch_server()
+
+    def _watch_server(self):
+        GLib.io_add_watch(self.server_sck.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN, self._on_accept)
+
+    def _on_accept(self, fd, condition):
+        try:
+            client_sck, _ = self.server_sck.accept()
+        except BlockingIOError:
+            return True # keep waiting
+        client_sck.setblocking(False)
+        client_sck.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        GLib.io_add_watch(client_sck.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self._on_readable, client_sck)
+        return False # only one client at a time
+
+    def _on_readable(self, fd, condition, sck):
+        try:
+            data = self._drain(sck)
+            if data is not None:
+                if data:
+                    self.on_bytes(data)
+                return True # keep watching
+        except ProtocolViolation:
+            traceback.print_exc(file=sys.stderr)
+        except OSError:
+            traceback.print_exc(file=sys.stderr)
+        try:
+            sck.close()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+        self._watch_server() # accept the next client
+        return False
+
+    def _drain(self, sck, max_reads=16):
+        """read what is queued, without blocking. None if the connection closed."""
+        chunks = []
+        for _ in range(max_reads):
             try:
-                client_address = server_sck.accept()
-                yield from self._read_bytes(client_address[0])
-            except ProtocolViolation:
-                traceback.print_exc(file=sys.stderr)
-            finally:
-                try:
-                    client_address[0].close()
-                except Exception:
-                    traceback.print_exc(file=sys.stderr)
-
-    def _read_bytes(self, sck):
-        while True:
-            data = sck.recv(1024)
+                data = sck.recv(65536)
+            except BlockingIOError:
+                break # nothing (more) queued; b"" after a spurious wakeup
             if not data:
-                break # Connection closed
-            yield from data
+                if not chunks:
+                    return None # Connection closed
+                break # Connection closed; the next wakeup will notice
+            chunks.append(data)
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
 
 
 class StdinByteSource(object):
 
-    def get_bytes(self):
-        source = sys.stdin.buffer # .buffer is in binary mode
-        while True:
-            byte = source.read(1)
-            if byte:
-                yield ord(byte)
-            else:
-                return # EOF
+    def start(self, on_bytes):
+        """call `on_bytes(chunk)` from the main loop when data arrives"""
+        self.on_bytes = on_bytes
+        GLib.io_add_watch(sys.stdin.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._on_readable)
+
+    def _on_readable(self, fd, condition):
+        data = os.read(fd, 65536) # won't block, fd is readable
+        if not data:
+            return False # EOF
+        try:
+            self.on_bytes(data)
+        except ProtocolViolation:
+            traceback.print_exc(file=sys.stderr)
+            return False
+        return True
 
 
-class Controller(threading.Thread):
+class Controller(object):
 
     def __init__(self, model, byte_source):
         self.byte_source = byte_source
         self.model = model
-        threading.Thread.__init__(self)
-        self.daemon = True
+        self.reset()
 
-    def run(self): # runs in its own thread
-        for frame in self.read_frames(self.byte_source.get_bytes()):
+    def start(self):
+        self.byte_source.start(self.on_bytes)
+
+    def on_bytes(self, chunk):
+        for frame in self.feed(chunk):
             print(frame)
-            if frame == [0xfe]:
+            if frame == b"\xfe":
                 self.model.strobe()
             elif len(frame) >= 1:
                 for channel, value in enumerate(frame[1:]):
                     self.model.set_value(frame[0], channel, value)
             else:
+                self.reset()
                 raise ProtocolViolation()
 
-    def read_frames(self, byte_stream):
-        STATE_IGNORE = 0
-        STATE_NORMAL = 1
-        STATE_ESCAPE = 2
-
-        ESCAPE_MARK = 0x54
-        START_MARK = 0x55
-        ESCAPE_ESCAPED = 0x00
-        START_ESCAPED = 0x01
+    def reset(self):
+        """forget any partially received frame; resynchronize"""
+        self._state = STATE_IGNORE
+        self._payload_buf = bytearray() # still escaped
+        if numba is not None:
+            self._carry = numpy.empty(0, dtype=numpy.uint8) # incomplete frame
 
-        payload_buf = []
-        state = STATE_IGNORE
+    def feed(self, chunk):
+        """parse a chunk of received bytes. yields the completed frames.
 
-        for num in byte_stream:
+        frames completed before a protocol violation are yielded
+        before ProtocolViolation is raised."""
+        try:
+            if numba is not None:
+                yield from self._feed_jit(chunk)
+            else:
+                yield from self._feed_py(chunk)
+        except ProtocolViolation:
+            self.reset()
+            raise
+
+    def _feed_jit(self, chunk):
+        carry = self._carry
+        buf = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        payload = numpy.empty(len(carry) + len(buf), dtype=numpy.uint8)
+        payload[:len(carry)] = carry
+        frame_ends = numpy.empty(len(buf), dtype=numpy.intp)
+
+        state, payload_len, frame_count = _scan_chunk(
+            buf, self._state, payload, len(carry), frame_ends)
+
+        frame_start = 0
+        frames = []
+        for frame_end in frame_ends[:frame_count]:
+            frames.append(bytearray(payload[frame_start:frame_end]))
+            frame_start = frame_end
+        if state != STATE_VIOLATION:
+            self._state = state
+            self._carry = payload[frame_start:payload_len]
+
+        yield from frames
+        if state == STATE_VIOLATION:
+            raise ProtocolViolation()
+
+    def _feed_py(self, chunk):
+        pos = 0
+
+        # start state; synchronize to start of a frame
+        if self._state == STATE_IGNORE:
+            pos = chunk.find(START_MARK)
+            if pos < 0:
+                return
+            pos += 1
+            self._state = STATE_NORMAL
+
+        # only stop at start marks, copy everything in between in one go
+        mark = chunk.find(START_MARK, pos)
+        while mark >= 0: # start of new frame
+            payload_buf = self._payload_buf
+            payload_buf += chunk[pos:mark]
+            self._payload_buf = bytearray()
+            pos = mark + 1
+            yield unescape(payload_buf)
+            mark = chunk.find(START_MARK, pos)
+        self._payload_buf += chunk[pos:]
+
+
+def unescape(buf):
+    """unescape a frame's payload. returns `buf` itself if it has no escapes."""
+    pos = buf.find(ESCAPE_MARK)
+    if pos < 0:
+        return buf # common case
+
+    res = bytearray()
+    start = 0
+    while pos >= 0:
+        res += buf[start:pos]
+        try:
+            res.append(_UNESCAPE[buf[pos + 1]])
+        except (IndexError, KeyError):
+            raise ProtocolViolation()
+        start = pos + 2
+        pos = buf.find(ESCAPE_MARK, start)
+    res += buf[start:]
+    return res
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _scan_chunk(buf, state, payload, payload_len, frame_ends):
+        """
+        unescape `buf` into `payload`, starting at `payload_len`.
+
+        the payload length after each completed frame is stored
+        in `frame_ends`. returns the new state, the new payload
+        length and the number of completed frames.
+        """
+        frame_count = 0
+        for num in buf:
 
             # start state; synchronize to start of a frame
             if state == STATE_IGNORE:
@@ -237,21 +448,39 @@ class Controller(threading.Thread):
                 if num == ESCAPE_MARK:
                     state = STATE_ESCAPE
                 elif num == START_MARK: # start of new frame
-                    yield payload_buf
-                    payload_buf = []
+                    frame_ends[frame_count] = payload_len
+                    frame_count += 1
                 else:
-                    payload_buf.append(num)
+                    payload[payload_len] = num
+                    payload_len += 1
 
             # within a frame, after an escape mark
-            elif state == STATE_ESCAPE:
+            else:
                 if num == ESCAPE_ESCAPED:
-                    payload_buf.append(ESCAPE_MARK)
-                    state = STATE_NORMAL
+                    payload[payload_len] = ESCAPE_MARK
                 elif num == START_ESCAPED:
-                    payload_buf.append(START_MARK)
-                    state = STATE_NORMAL
+                    payload[payload_len] = START_MARK
                 else:
-                    raise ProtocolViolation()
+                    return STATE_VIOLATION, payload_len, frame_count
+                payload_len += 1
+                state = STATE_NORMAL
+
+        return state, payload_len, frame_count
+
+    @numba.njit(parallel=True, cache=True)
+    def _render_cells(pixels, front_buffer, cell_rects, cells):
+        """fill the pixels of the given cells, in parallel"""
+        for n in numba.prange(len(cells)):
+            cell = cells[n]
+            color = numpy.uint32(0xff000000
+                | numpy.uint32(front_buffer[3 * cell]) << 16
+                | numpy.uint32(front_buffer[3 * cell + 1]) << 8
+                | numpy.uint32(front_buffer[3 * cell + 2]))
+            x0 = cell_rects[cell, 0]
+            y0 = cell_rects[cell, 1]
+            x1 = cell_rects[cell, 2]
+            y1 = cell_rects[cell, 3]
+            pixels[y0:y1, x0:x1] = color
 
 
 class ProtocolViolation(Exception):
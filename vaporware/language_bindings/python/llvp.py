@@ -3,35 +3,82 @@
 import argparse
 import time
 import socket
+import struct
 
 
 __version__ = "0.3.0"
 
 
+# opcode, led, r, g, b, a
+_SET_LED = struct.Struct(">cHBBBB")
+_HIGH_RES_SET_LED = struct.Struct(">cHHHHH")
+_pack_set_led = _SET_LED.pack
+_pack_high_res_set_led = _HIGH_RES_SET_LED.pack
+_pack_high_res_set_led_into = _HIGH_RES_SET_LED.pack_into
+
+# max. number of buffers per sendmsg() call (linux' UIO_MAXIOV)
+_IOV_MAX = 1024
+
+
 class FilelikeController(object):
 
     def __init__(self, f, token):
         self._filelike = f
+        self._pending = [] # serialized commands not sent yet
+        self._shadow = {} # led -> (command class, rgba) last sent
         self._send(AuthenticateCommand(token))
+        self.flush()
 
     def _send(self, command):
-        self._filelike.sendall(command.to_str())
+        self._pending.append(command.to_bytes())
+
+    def _set_led(self, command_class, led, rgba):
+        rgba = tuple(rgba)
+        state = (command_class, rgba)
+        if self._shadow.get(led) == state:
+            return # the device already has this color
+        self._shadow[led] = state
+        self._send(command_class(led, rgba))
+
+    def flush(self):
+        """send all queued commands now. strobe() does this implicitly."""
+        if not self._pending:
+            return
+        sendmsg = getattr(self._filelike, "sendmsg", None)
+        if sendmsg is None:
+            self._filelike.sendall(b"".join(self._pending))
+        else:
+            self._sendmsg_all(sendmsg, self._pending)
+        self._pending = []
+
+    @staticmethod
+    def _sendmsg_all(sendmsg, buffers):
+        """like sendall, but gathers the buffers in the kernel"""
+        while buffers:
+            sent = sendmsg(buffers[:_IOV_MAX])
+            done = 0
+            while done < len(buffers) and sent >= len(buffers[done]):
+                sent -= len(buffers[done])
+                done += 1
+            buffers = buffers[done:]
+            if sent: # partially sent buffer
+                buffers[0] = buffers[0][sent:]
 
     def set_rgb(self, led, rgb, a=255):
         """set colors with 8 bit precision. deprecated."""
-        self._send(SetLedCommand(led, (rgb[0], rgb[1], rgb[2], a)))
+        self._set_led(SetLedCommand, led, (rgb[0], rgb[1], rgb[2], a))
 
     def set_rgb_hi(self, led, rgb, a=65535):
         """set colors with 16 bit precision."""
-        self._send(HighResSetLedCommand(led, (rgb[0], rgb[1], rgb[2], a)))
+        self._set_led(HighResSetLedCommand, led, (rgb[0], rgb[1], rgb[2], a))
 
     def set_rgba(self, led, rgba):
         """set colors with 8 bit precision. deprecated."""
-        self._send(SetLedCommand(led, rgba))
+        self._set_led(SetLedCommand, led, rgba)
 
     def set_rgba_hi(self, led, rgba):
         """set colors with 16 bit precision."""
-        self._send(HighResSetLedCommand(led, rgba))
+        self._set_led(HighResSetLedCommand, led, rgba)
 
     def set_rgb_a(self, led, rgb, a=255):
         """deprecated. for backwards compatibility only."""
@@ -40,10 +87,12 @@ class FilelikeController(object):
     def strobe(self):
         """make updates take effect"""
         self._send(StrobeCommand())
+        self.flush()
 
     def close(self):
         """close the connection, cleanly removing our LED state from the device"""
         self._filelike.close()
+        self._shadow.clear()
 
     def done(self):
         """enter an infinite loop, keeping sockets open"""
@@ -57,26 +106,66 @@ class SocketController(FilelikeController):
         sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         print("connecting to %s, %s" % (host, port))
         sck.connect((host, port))
+        sck.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         super(SocketController, self).__init__(sck, token)
 
 
 class NetProtocol(object):
 
-    def read(self):
-        opcode = yield
-        while True:
-            if opcode == SetLedCommand.opcode:
-                opcode = yield SetLedCommand(ord((yield))<<8|ord((yield)),
-                    (ord((yield)), ord((yield)), ord((yield)), ord((yield))))
-            elif opcode == StrobeCommand.opcode:
-                opcode = yield StrobeCommand()
-            elif opcode == AuthenticateCommand.opcode:
-                opcode = yield AuthenticateCommand([(yield) for i in range(16)])
+    def __init__(self):
+        self._buf = bytearray() # received, but not parsed yet
+
+    def feed(self, chunk):
+        """
+        parse received bytes. returns the list of completed commands.
+
+        on an unknown opcode, the rest of the input is dropped and
+        ProtocolError is raised; its `commands` attribute holds the
+        commands completed before it.
+        """
+        buf = self._buf
+        buf += chunk
+        set_led = ord(SetLedCommand.opcode)
+        high_res_set_led = ord(HighResSetLedCommand.opcode)
+        strobe = ord(StrobeCommand.opcode)
+        authenticate = ord(AuthenticateCommand.opcode)
+
+        commands = []
+        pos = 0
+        end = len(buf)
+        while pos < end:
+            opcode = buf[pos]
+            if opcode == set_led:
+                if pos + _SET_LED.size > end:
+                    break # incomplete
+                _, led, r, g, b, a = _SET_LED.unpack_from(buf, pos)
+                commands.append(SetLedCommand(led, (r, g, b, a)))
+                pos += _SET_LED.size
+            elif opcode == high_res_set_led:
+                if pos + _HIGH_RES_SET_LED.size > end:
+                    break # incomplete
+                _, led, r, g, b, a = _HIGH_RES_SET_LED.unpack_from(buf, pos)
+                commands.append(HighResSetLedCommand(led, (r, g, b, a)))
+                pos += _HIGH_RES_SET_LED.size
+            elif opcode == strobe:
+                commands.append(StrobeCommand())
+                pos += 1
+            elif opcode == authenticate:
+                if pos + 17 > end:
+                    break # incomplete
+                commands.append(AuthenticateCommand(buf[pos + 1:pos + 17]))
+                pos += 17
             else:
-                raise ProtocolError()
+                buf.clear() # can't resynchronize after an unknown opcode
+                error = ProtocolError()
+                error.commands = commands
+                raise error
+
+        del buf[:pos]
+        return commands
 
 class UnexpectedSyncError(Exception):
-    pass
+    commands = () # completed before the error, see BusProtocol.feed()
 
 class BusProtocol(object):
 
@@ -90,67 +179,137 @@ class BusProtocol(object):
 
     def __init__(self, lens):
         self.module_lens = lens
+        self._buf = bytearray() # received, but not parsed yet
+
+    @classmethod
+    def unescape(cls, buf):
+        """unescape a bytearray. returns `buf` itself if it has no escapes."""
+        pos = buf.find(cls.ESCAPE_BYTE)
+        if pos < 0:
+            return buf # common case
+
+        res = bytearray()
+        start = 0
+        while pos >= 0:
+            res += buf[start:pos]
+            try:
+                res.append(cls.UNESCAPE[buf[pos + 1]])
+            except (IndexError, KeyError):
+                raise ProtocolError()
+            start = pos + 2
+            pos = buf.find(cls.ESCAPE_BYTE, start)
+        res += buf[start:]
+        return res
 
-    def read(self):
-        first_byte_after_cmd = 0x00
-        while True:
-            if first_byte_after_cmd != 0x55:
-                while ord((yield)) != 0x55:
-                    print("skipping")
-                    pass
-
-            addr = ord((yield))
-            if addr == self.ESCAPE_BYTE:
-                addr = self.UNESCAPE[(yield)]
-            elif addr == self.START_OF_CMD_MARKER:
-                raise UnexpectedSyncError()
-
-            if addr == self.STROBE_PADDR:
-                first_byte_after_cmd = ord((yield BusStrobeCommand()))
-            elif addr == self.START_OF_CMD_MARKER:
+    def feed(self, chunk):
+        """
+        parse received bytes. returns the list of completed commands.
+
+        bad frames are skipped, resynchronizing at the next start mark.
+        the first error is raised once all of the input is parsed; its
+        `commands` attribute holds all completed commands.
+        """
+        buf = self._buf
+        buf += chunk
+
+        commands = []
+        error = None
+        pos = buf.find(self.START_OF_CMD_MARKER) # skip to start of a frame
+        while pos >= 0:
+            try:
+                frame = self._parse_frame(buf, pos + 1)
+            except (UnexpectedSyncError, ProtocolError) as e:
+                if error is None:
+                    error = e
+                pos = buf.find(self.START_OF_CMD_MARKER, pos + 1)
+                continue
+            if frame is None:
+                break # incomplete
+            command, pos = frame
+            commands.append(command)
+            pos = buf.find(self.START_OF_CMD_MARKER, pos)
+
+        if pos < 0:
+            buf.clear()
+        else:
+            del buf[:pos]
+        if error is not None:
+            error.commands = commands
+            raise error
+        return commands
+
+    def _parse_frame(self, buf, pos):
+        """
+        parse the frame whose payload starts at `pos`.
+        returns the command and the position after the frame,
+        or None if the frame is not complete yet.
+        """
+        end = len(buf)
+        next_frame = buf.find(self.START_OF_CMD_MARKER, pos)
+        limit = end if next_frame < 0 else next_frame
+
+        if pos >= limit:
+            if next_frame >= 0:
                 raise UnexpectedSyncError()
-            else:
-                continue_reading = self.module_lens[addr]
-                values = []
-                while continue_reading:
-                    new_values = [ord((yield)) for _ in range(continue_reading)]
-
-                    if self.START_OF_CMD_MARKER in new_values:
-                        raise UnexpectedSyncError()
-
-                    num_of_escapes = len([True for val in new_values if val == self.ESCAPE_BYTE])
-                    continue_reading = num_of_escapes
-
-                    values.extend(new_values)
-
-                unescaped = []
-                escaped = False
-                for val in values:
-                    if val == self.ESCAPE_BYTE:
-                        escaped = True
-                    else:
-                        if escaped:
-                            unescaped.append(self.UNESCAPE[val])
-                            escaped = False
-                        else:
-                            unescaped.append(val)
-
-                first_byte_after_cmd = ord((yield BusSetChannelsCommand(addr, unescaped)))
+            return None
+        addr = buf[pos]
+        if addr == self.ESCAPE_BYTE:
+            if pos + 1 >= limit:
+                if next_frame >= 0:
+                    raise UnexpectedSyncError()
+                return None
+            try:
+                addr = self.UNESCAPE[buf[pos + 1]]
+            except KeyError:
+                raise ProtocolError()
+            pos += 2
+        else:
+            pos += 1
+
+        if addr == self.STROBE_PADDR:
+            return BusStrobeCommand(), pos
+        elif addr == self.START_OF_CMD_MARKER:
+            raise UnexpectedSyncError()
+
+        # every escape mark makes the frame one byte longer
+        frame_end = pos
+        try:
+            continue_reading = self.module_lens[addr]
+        except IndexError:
+            raise ProtocolError() # unknown module
+        while continue_reading:
+            new_end = frame_end + continue_reading
+            if new_end > limit:
+                if next_frame >= 0:
+                    raise UnexpectedSyncError()
+                return None
+            continue_reading = buf.count(self.ESCAPE_BYTE, frame_end, new_end)
+            frame_end = new_end
+
+        unescaped = list(self.unescape(buf[pos:frame_end]))
+        return BusSetChannelsCommand(addr, unescaped), frame_end
 
 
 class StrobeCommand(object):
-    opcode = "\xff"
+    opcode = b"\xff"
 
-    def to_str(self):
+    def to_bytes(self):
         return self.opcode
 
 
 class BusStrobeCommand(object):
     opcode = BusProtocol.STROBE_PADDR
 
-    def to_str(self):
-        return chr(BusProtocol.START_OF_CMD_MARKER) +\
-               chr(BusProtocol.STROBE_PADDR)
+    def to_bytes(self):
+        return bytes([BusProtocol.START_OF_CMD_MARKER,
+                      BusProtocol.STROBE_PADDR])
+
+
+# byte value -> escaped bytes as sent on the bus
+_ESCAPE_TABLE = [bytes([value]) for value in range(256)]
+_ESCAPE_TABLE[BusProtocol.ESCAPE_BYTE] = bytes([BusProtocol.ESCAPE_BYTE, 0x00])
+_ESCAPE_TABLE[BusProtocol.START_OF_CMD_MARKER] = bytes([BusProtocol.ESCAPE_BYTE, 0x01])
+_START_OF_CMD = bytes([BusProtocol.START_OF_CMD_MARKER])
 
 
 class BusSetChannelsCommand(object):
@@ -158,30 +317,22 @@ class BusSetChannelsCommand(object):
         self.mod_id = mod_id
         self.channels = channels
 
-    def to_str(self):
-        res = chr(BusProtocol.START_OF_CMD_MARKER)
-        for value in [self.mod_id] + self.channels:
-            if value in BusProtocol.UNESCAPE.values():
-                res.append(chr(BusProtocol.ESCAPE_BYTE) +
-                           chr(value - BusProtocol.ESCAPE_BYTE))
-        return res
+    def to_bytes(self):
+        escape_table = _ESCAPE_TABLE
+        parts = [_START_OF_CMD, escape_table[self.mod_id]]
+        parts.extend([escape_table[value] for value in self.channels])
+        return b"".join(parts)
 
 
 class SetLedCommand(object):
-    opcode = "\x01"
+    opcode = b"\x01"
 
     def __init__(self, led, color):
         self.led = led
         self._color = color
 
-    def to_str(self):
-        return "".join((self.opcode,
-            chr(self.led >> 8),
-            chr(self.led & 255),
-            chr(self._color[0]),
-            chr(self._color[1]),
-            chr(self._color[2]),
-            chr(self._color[3])))
+    def to_bytes(self):
+        return _pack_set_led(self.opcode, self.led, *self._color)
 
     @property
     def rgb(self):
@@ -193,13 +344,14 @@ class SetLedCommand(object):
 
 
 class AuthenticateCommand(object):
-    opcode = "\x02"
+    opcode = b"\x02"
 
     def __init__(self, token):
-        token = token.ljust(16, "\x00") # pad to 16 bytes
-        self._token = token;
+        if isinstance(token, str):
+            token = token.encode("latin-1")
+        self._token = bytes(token).ljust(16, b"\x00")[:16] # pad to 16 bytes
 
-    def to_str(self):
+    def to_bytes(self):
         return self.opcode + self._token
 
     @property
@@ -208,24 +360,19 @@ class AuthenticateCommand(object):
 
 
 class HighResSetLedCommand(object):
-    opcode = "\x03"
+    opcode = b"\x03"
 
     def __init__(self, led, color):
         self.led = led
         self._color = color
 
-    def to_str(self):
-        return "".join((self.opcode,
-            chr(self.led >> 8),
-            chr(self.led & 255),
-            chr(self._color[0] >> 8),
-            chr(self._color[0] & 255),
-            chr(self._color[1] >> 8),
-            chr(self._color[1] & 255),
-            chr(self._color[2] >> 8),
-            chr(self._color[2] & 255),
-            chr(self._color[3] >> 8),
-            chr(self._color[3] & 255)))
+    def to_bytes(self):
+        return _pack_high_res_set_led(self.opcode, self.led, *self._color)
+
+    def write_into(self, dest, offset=0):
+        """serialize into the writable buffer `dest`. returns the offset after it."""
+        _pack_high_res_set_led_into(dest, offset, self.opcode, self.led, *self._color)
+        return offset + _HIGH_RES_SET_LED.size
 
     @property
     def rgb(self):
@@ -237,7 +384,7 @@ class HighResSetLedCommand(object):
 
 
 class ProtocolError(Exception):
-    pass
+    commands = () # completed before the error, see the feed() methods
 
 
 def main(func):
@@ -0,0 +1,63 @@
+"""Tests for the protocol parsers in llvp."""
+
+import unittest
+
+import llvp
+
+
+class BusProtocolTest(unittest.TestCase):
+
+    def test_bad_frame_between_good_frames(self):
+        parser = llvp.BusProtocol([3])
+        data = (llvp.BusStrobeCommand().to_bytes()
+            + b"\x55\x00\x54\x07\x01\x02" # invalid escape
+            + llvp.BusSetChannelsCommand(0, [1, 2, 3]).to_bytes())
+        with self.assertRaises(llvp.ProtocolError) as cm:
+            parser.feed(data)
+        commands = cm.exception.commands
+        self.assertEqual(len(commands), 2)
+        self.assertIsInstance(commands[0], llvp.BusStrobeCommand)
+        self.assertEqual(commands[1].mod_id, 0)
+        self.assertEqual(commands[1].channels, [1, 2, 3])
+
+    def test_keeps_frame_after_unexpected_sync(self):
+        parser = llvp.BusProtocol([3])
+        with self.assertRaises(llvp.UnexpectedSyncError) as cm:
+            parser.feed(b"\x55\xfe\x55\x00\x01\x55\xfe\x55")
+        commands = cm.exception.commands
+        self.assertEqual(len(commands), 2)
+        self.assertTrue(all(isinstance(command, llvp.BusStrobeCommand)
+            for command in commands))
+
+    def test_recovers_after_error(self):
+        parser = llvp.BusProtocol([3])
+        with self.assertRaises(llvp.ProtocolError):
+            parser.feed(b"\x55\x00\x54\x07\x01\x02")
+        commands = parser.feed(b"\x55\xfe")
+        self.assertEqual(len(commands), 1)
+        self.assertIsInstance(commands[0], llvp.BusStrobeCommand)
+
+
+class NetProtocolTest(unittest.TestCase):
+
+    def test_keeps_commands_before_unknown_opcode(self):
+        parser = llvp.NetProtocol()
+        with self.assertRaises(llvp.ProtocolError) as cm:
+            parser.feed(b"\x01\x00\x01\x01\x02\x03\x04\xff\x07")
+        commands = cm.exception.commands
+        self.assertEqual(len(commands), 2)
+        self.assertEqual(commands[0].led, 1)
+        self.assertEqual(commands[0].rgba, (1, 2, 3, 4))
+        self.assertIsInstance(commands[1], llvp.StrobeCommand)
+
+    def test_recovers_after_error(self):
+        parser = llvp.NetProtocol()
+        with self.assertRaises(llvp.ProtocolError):
+            parser.feed(b"\x07\xff")
+        commands = parser.feed(b"\xff")
+        self.assertEqual(len(commands), 1)
+        self.assertIsInstance(commands[0], llvp.StrobeCommand)
+
+
+if __name__ == "__main__":
+    unittest.main()